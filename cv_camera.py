@@ -4,9 +4,17 @@ import cv2
 import time
 import json
 import logging
+import shutil
+import threading
+import numpy as np
+import torch
+import torch.nn.functional as F
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ultralytics import YOLO
 import paho.mqtt.client as mqtt
 from datetime import datetime
+from cv_hot import extract_detections, publish_detections
 
 
 # --- Configuration Loading ---
@@ -15,7 +23,12 @@ def load_config():
         return json.load(f)
 
 config = load_config()
-os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
+
+# Decode H.264 on the GPU's NVDEC block if enabled; needs an OpenCV/FFmpeg build with CUDA
+if config.get("hw_decode", False):
+    os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp|hwaccel;cuvid|video_codec;h264_cuvid|vsync;0"
+else:
+    os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;tcp"
 
 CAMERAS = config["cameras"]
 MODEL_PATH = config["model_path"]
@@ -25,59 +38,252 @@ MQTT_PORT = config["mqtt"]["port"]
 MQTT_USER = config["mqtt"]["user"]
 MQTT_PASS = config["mqtt"]["pass"]
 
-# Logging Setup
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# (state topic, processed topic) per camera, built once instead of every tick
+TOPICS = {
+    camera["name"]: (f"objectdetection/{camera['name']}/state", f"objectdetection/{camera['name']}/processed")
+    for camera in CAMERAS
+}
+
+IMGSZ = 640
+INT8 = config.get("int8", False)
+MOTION_THRESHOLD = config.get("motion_threshold", 3.0)
+CALIB_FRAMES = 200
+CALIB_SPACING = 1  # seconds between calibration rounds, so frames are not near-duplicates
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
-def get_camera_frame(rtsp_url):
-    """Connects to RTSP, clears buffer, captures one frame, and disconnects."""
-    logging.debug(f"Connecting to RTSP stream: {rtsp_url}")
-    cap = cv2.VideoCapture(rtsp_url)
+# Fixed shape so TensorRT/cuDNN reuse the same tuned kernels every tick
+PREDICT_ARGS = dict(conf=0.5, verbose=False, imgsz=IMGSZ, batch=len(CAMERAS))
 
-    if not cap.isOpened():
-        logging.error(f"Could not open RTSP stream at {rtsp_url}")
-        return None
+# A TensorRT engine's device and precision are fixed at export (forcing half on an INT8
+# engine would feed its fp32 input binding fp16 data), so only the PyTorch fallback sets them
+TORCH_PREDICT_ARGS = dict(PREDICT_ARGS, device=0 if DEVICE == "cuda" else "cpu", half=DEVICE == "cuda")
 
-    # Read a few frames to clear buffer/auto-exposure (warmup)
-    for _ in range(5):
-        ret, _ = cap.read()
-        if not ret:
-            logging.warning(f"Failed to read frame during warmup for {rtsp_url}")
-            break
+# Uploads run on their own stream so they overlap with captures still in flight;
+# torch.cuda.stream(None) is a no-op, so the same code runs on CPU-only hosts.
+COPY_STREAM = torch.cuda.Stream() if DEVICE == "cuda" else None
 
-    ret, frame = cap.read()
-    cap.release() # Release immediately to save resources during sleep
+# One worker per camera so all snapshots of a tick are requested concurrently
+CAPTURE_POOL = ThreadPoolExecutor(max_workers=len(CAMERAS), thread_name_prefix="capture")
 
-    if ret:
-        return frame
-    else:
-        logging.error("Failed to retrieve frame")
-        return None
+# JPEG encode and disk writes run here so they overlap with inference
+JPEG_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="jpeg")
+JPEG_QUALITY = 85
+
+# Logging Setup
+logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def save_frame(frame, folder, camera_name):
+class CameraGrabber(threading.Thread):
+    """Keeps an RTSP stream open and holds the most recent frame on request."""
+
+    RECONNECT_DELAY = 5
+    SNAPSHOT_TIMEOUT = 10
+
+    def __init__(self, camera_name, rtsp_url):
+        super().__init__(name=f"grabber-{camera_name}", daemon=True)
+        self.camera_name = camera_name
+        self.rtsp_url = rtsp_url
+        self.latest = None
+        self.lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._ready = threading.Event()
+
+    def run(self):
+        while True:
+            logging.debug(f"Connecting to RTSP stream: {self.rtsp_url}")
+            cap = cv2.VideoCapture(self.rtsp_url)
+
+            if not cap.isOpened():
+                logging.error(f"Could not open RTSP stream at {self.rtsp_url}")
+                time.sleep(self.RECONNECT_DELAY)
+                continue
+
+            # grab() keeps the stream drained; only decode to BGR when a tick asks for it
+            while cap.grab():
+                if self._wanted.is_set():
+                    ret, frame = cap.retrieve()
+                    if ret:
+                        with self.lock:
+                            self.latest = frame
+                    else:
+                        logging.error(f"Failed to retrieve frame for {self.camera_name}")
+                    self._wanted.clear()
+                    self._ready.set()
+
+            logging.warning(f"Lost RTSP stream for {self.camera_name}, reconnecting")
+            cap.release()
+            time.sleep(self.RECONNECT_DELAY)
+
+    def snapshot(self):
+        """Returns the next decoded frame, or None if the stream did not deliver one in time."""
+        with self.lock:
+            self.latest = None
+        self._ready.clear()
+        self._wanted.set()
+        if not self._ready.wait(self.SNAPSHOT_TIMEOUT):
+            logging.error(f"Timed out waiting for a frame from {self.camera_name}")
+        with self.lock:
+            return self.latest
+
+# Reusable pinned host buffer per camera for the H2D copy
+_pinned = {}
+
+def preprocess(frame, camera_name):
+    """Uploads a BGR frame on the copy stream as a letterboxed, normalized RGB 1x3xIMGSZxIMGSZ tensor."""
+    t = torch.from_numpy(frame)
+    if DEVICE == "cuda":
+        pinned = _pinned.get(camera_name)
+        if pinned is None or pinned.shape != t.shape:
+            pinned = _pinned[camera_name] = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+        t = pinned.copy_(t)
+
+    with torch.cuda.stream(COPY_STREAM):
+        t = t.to(DEVICE, non_blocking=True)
+        t = t[..., [2, 1, 0]].permute(2, 0, 1).unsqueeze(0).float().mul_(1 / 255.0)
+        return letterbox(t)
+
+def letterbox(t):
+    """Resizes a 1x3xHxW tensor to fit IMGSZ keeping aspect ratio and pads with gray, as Ultralytics does."""
+    h, w = t.shape[-2:]
+    r = min(IMGSZ / h, IMGSZ / w)
+    new_h, new_w = round(h * r), round(w * r)
+    if (new_h, new_w) != (h, w):
+        t = F.interpolate(t, size=(new_h, new_w), mode="bilinear", align_corners=False)
+
+    # Split the padding evenly around the image, matching Ultralytics' LetterBox rounding
+    dh, dw = (IMGSZ - new_h) / 2, (IMGSZ - new_w) / 2
+    top, bottom = round(dh - 0.1), round(dh + 0.1)
+    left, right = round(dw - 0.1), round(dw + 0.1)
+    return F.pad(t, (left, right, top, bottom), value=114 / 255.0)
+
+def run_inference(model, tensors, predict_args):
+    """Runs one batched forward pass on the default stream once all uploads are done."""
+    with torch.cuda.stream(COPY_STREAM):
+        batch = torch.cat(tensors)
+    if COPY_STREAM is not None:
+        # Predict stays on the default stream, which TensorRT's execute_v2 is ordered against
+        torch.cuda.current_stream().wait_stream(COPY_STREAM)
+        batch.record_stream(torch.cuda.current_stream())
+
+    with torch.inference_mode():
+        return model.predict(batch, **predict_args)
+
+def warmup(model, predict_args, runs=3):
+    """Runs dummy batches so kernel selection and engine setup happen before the first tick."""
+    # Created directly on the device (on the copy stream run_inference expects) so no
+    # throwaway pinned buffers end up in the per-camera cache
+    with torch.cuda.stream(COPY_STREAM):
+        dummy = torch.zeros((1, 3, IMGSZ, IMGSZ), device=DEVICE)
+    for _ in range(runs):
+        run_inference(model, [dummy] * len(CAMERAS), predict_args)
+
+def frame_changed(frame, prev_gray):
+    """Compares a downscaled grayscale copy of the frame with the last inferred one.
+
+    Returns whether the mean absolute difference exceeds MOTION_THRESHOLD,
+    and the frame's grayscale image to keep if it goes on to inference.
+    """
+    gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), (160, 90))
+    if prev_gray is None:
+        return True, gray
+    return cv2.absdiff(gray, prev_gray).mean() >= MOTION_THRESHOLD, gray
+
+# Folders already known to exist, so each one is only checked once per process
+_ensured_folders = set()
+
+def save_frame(frame, folder, camera_name, timestamp):
     """Saves the frame to the specified folder."""
     logging.debug(f"Attempting to save frame for {camera_name} in {folder}")
-    if not os.path.exists(folder):
+    if folder not in _ensured_folders:
         try:
-            os.makedirs(folder)
+            os.makedirs(folder, exist_ok=True)
         except OSError as e:
             logging.error(f"Failed to create directory {folder}: {e}")
             return
+        _ensured_folders.add(folder)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     filename = f"{folder}/{camera_name}_{timestamp}.jpg"
     try:
-        cv2.imwrite(filename, frame)
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+        if not ok:
+            logging.error(f"Failed to encode frame {filename}")
+            return
+        Path(filename).write_bytes(buf.tobytes())
         logging.info(f"Saved frame to {filename}")
     except Exception as e:
         logging.error(f"Failed to save frame {filename}: {e}")
 
 
+def collect_calibration_frames(grabbers, folder):
+    """Captures CALIB_FRAMES frames spread over all cameras for INT8 calibration."""
+    os.makedirs(folder, exist_ok=True)
+    rounds = -(-CALIB_FRAMES // len(grabbers))  # ceil division
+    logging.info(f"Collecting {rounds * len(grabbers)} calibration frames into {folder}...")
+    for i in range(rounds):
+        for camera_name, grabber in grabbers.items():
+            frame = grabber.snapshot()
+            if frame is not None:
+                cv2.imwrite(f"{folder}/{camera_name}_{i:04d}.jpg", frame)
+        time.sleep(CALIB_SPACING)
+
+def engine_path_for(model_path):
+    """Returns where the TensorRT engine for the configured precision and camera count is cached."""
+    # The engine's max batch is fixed at export, so a change in camera count needs a new engine
+    path = Path(model_path)
+    precision = "_int8" if INT8 else ""
+    return path.with_name(f"{path.stem}{precision}_b{len(CAMERAS)}.engine")
+
+def export_engine(model_path, grabbers):
+    """Exports the model to a TensorRT engine, calibrating on live frames for INT8."""
+    # dynamic=True so ticks with fewer frames than cameras still fit the engine
+    kwargs = dict(format="engine", imgsz=IMGSZ, batch=len(CAMERAS), dynamic=True)
+    if not INT8:
+        # Ultralytics always writes <stem>.engine; cache it under the batch-specific name
+        return Path(YOLO(model_path).export(half=True, **kwargs)).replace(engine_path_for(model_path))
+
+    calib_dir = Path(model_path).parent / "calib"
+    collect_calibration_frames(grabbers, str(calib_dir / "images"))
+
+    # Export from a copy inside calib/ so Ultralytics' <stem>.engine output lands there
+    # and cannot overwrite an FP16 engine next to the original model
+    calib_model_path = calib_dir / Path(model_path).name
+    shutil.copy2(model_path, calib_model_path)
+    model = YOLO(str(calib_model_path))
+
+    # JSON is valid YAML, so the dataset file needs no extra dependency
+    data_yaml = calib_dir / "calib.yaml"
+    data_yaml.write_text(json.dumps({
+        "path": str(calib_dir),
+        "train": "images",
+        "val": "images",
+        "names": model.names
+    }))
+    exported = Path(model.export(int8=True, data=str(data_yaml), **kwargs))
+    # Ultralytics always writes <stem>.engine; keep INT8 engines under their own name
+    return exported.replace(engine_path_for(model_path))
+
+def load_model(model_path, grabbers):
+    """Loads the model as a TensorRT engine (FP16, or INT8 if configured), exporting it on first run.
+
+    Returns the model and the predict arguments that suit it.
+    """
+    engine_path = engine_path_for(model_path)
+    if not engine_path.exists():
+        logging.info(f"No TensorRT engine at {engine_path}, exporting from {model_path}...")
+        try:
+            engine_path = export_engine(model_path, grabbers)
+        except Exception as e:
+            logging.warning(f"TensorRT export failed, falling back to PyTorch model: {e}")
+            return YOLO(model_path), TORCH_PREDICT_ARGS
+
+    logging.info(f"Loading TensorRT engine from {engine_path}")
+    return YOLO(str(engine_path), task="detect"), PREDICT_ARGS
+
+
 def publish_mqtt_discovery(client, cameras):
     """Publishes MQTT discovery messages for Home Assistant."""
     for camera in cameras:
         camera_name = camera["name"]
-        
-        state_topic = f"objectdetection/{camera_name}/state"
+        state_topic, processed_topic = TOPICS[camera_name]
 
         # Main sensor for all detections
         discovery_topic = f"homeassistant/sensor/object_detection/{camera_name}/config"
@@ -100,7 +306,6 @@ def publish_mqtt_discovery(client, cameras):
         logging.info(f"Published MQTT discovery for {camera_name} detections sensor.")
 
         # Sensor for the highest confidence detection
-        processed_topic = f"objectdetection/{camera_name}/processed"
         processed_discovery_topic = f"homeassistant/sensor/object_detection/{camera_name}_processed/config"
         processed_payload = {
             "name": f"{camera_name} Processed",
@@ -124,16 +329,30 @@ def publish_mqtt_discovery(client, cameras):
 
 
 def main():
-    # 1. Load the Model once at startup
+    # 1. Start one persistent capture thread per camera
+    grabbers = {camera["name"]: CameraGrabber(camera["name"], camera["url"]) for camera in CAMERAS}
+    for grabber in grabbers.values():
+        grabber.start()
+
+    # 2. Load the Model once at startup (INT8 calibration needs the grabbers)
     logging.info(f"Loading model from {MODEL_PATH}...")
     try:
-        model = YOLO(MODEL_PATH)
+        model, predict_args = load_model(MODEL_PATH, grabbers)
+        logging.info("Warming up model...")
+        warmup(model, predict_args)
     except Exception as e:
         logging.error(f"Failed to load model: {e}")
         return
 
-    # 2. Setup MQTT Client
+    # Class names as an array so a whole frame's class ids resolve in one gather
+    names = np.array([model.names[i] for i in range(len(model.names))])
+
+    # 3. Setup MQTT Client
     client = mqtt.Client()
+    # Per-tick publishes are QoS 0, so a wide window and unbounded queue keep them fire-and-forget
+    client.max_inflight_messages_set(200)
+    client.max_queued_messages_set(0)
+    client.reconnect_delay_set(1, 30)
     if MQTT_USER and MQTT_PASS:
         client.username_pw_set(MQTT_USER, MQTT_PASS)
 
@@ -149,79 +368,76 @@ def main():
         logging.error(f"MQTT Connection failed: {e}")
         return
 
-    # 3. Main Loop
+    # 4. Main Loop
     logging.info(f"Starting loop. Capturing every {INTERVAL} seconds.")
 
-    while True:
-        start_time = time.time() # Start time for the whole iteration
+    # Per-camera state for the motion gate
+    prev_gray = {}
+    last_detections = {}
 
-        for camera in CAMERAS:
-            camera_name = camera["name"]
+    # Ticks run on a fixed monotonic schedule, unaffected by wall-clock adjustments
+    next_tick = time.monotonic()
 
-            # --- A. Capture ---
-            frame = get_camera_frame(camera["url"])
+    while True:
+        next_tick += INTERVAL
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S") # Shared by all frames saved this tick
+
+        # --- A. Capture ---
+        # Each frame is uploaded as soon as its camera delivers, overlapping the
+        # H2D copies with the captures that are still running.
+        futures = {CAPTURE_POOL.submit(grabbers[camera["name"]].snapshot): camera for camera in CAMERAS}
+
+        tensors = []
+        cam_order = []
+        detections_by_camera = {}
+        for future in as_completed(futures):
+            camera = futures[future]
+            camera_name = camera["name"]
+            frame = future.result()
 
             if frame is not None:
                 # --- Save Frame ---
                 if "output_folder" in camera:
-                    save_frame(frame, camera["output_folder"], camera_name)
+                    # The grabber hands out a new array per snapshot, so no copy is needed
+                    JPEG_POOL.submit(save_frame, frame, camera["output_folder"], camera_name, timestamp)
+
+                # --- Motion Gate ---
+                # Compare against the last inferred frame, so slow drift still adds up to a change
+                changed, gray = frame_changed(frame, prev_gray.get(camera_name))
+                if not changed and camera_name in last_detections:
+                    logging.debug(f"No motion for {camera_name}, reusing last detections.")
+                    detections_by_camera[camera_name] = last_detections[camera_name]
+                    continue
+
+                prev_gray[camera_name] = gray
+                tensors.append(preprocess(frame, camera_name))
+                cam_order.append(camera_name)
+            else:
+                logging.warning(f"Skipping prediction for {camera_name} due to camera error.")
 
-                # --- B. Predict ---
-                results = model.predict(frame, conf=0.5, verbose=False)
+        if tensors:
+            # --- B. Predict (one batched forward pass for all cameras) ---
+            results_batch = run_inference(model, tensors, predict_args)
 
+            for camera_name, r in zip(cam_order, results_batch):
                 # --- C. Process Results ---
-                detections = []
-                for r in results:
-                    for box in r.boxes:
-                        cls_id = int(box.cls[0])
-                        class_name = model.names[cls_id]
-                        confidence = float(box.conf[0])
-                        detections.append({
-                            "object": class_name,
-                            "confidence": round(confidence, 2)
-                        })
+                detections = extract_detections(r, names)
 
                 logging.debug(f"Raw detections for {camera_name}: {detections}")
+                detections_by_camera[camera_name] = last_detections[camera_name] = detections
 
-                # --- D. Publish to MQTT ---
-                state_topic = f"objectdetection/{camera_name}/state"
-                processed_topic = f"objectdetection/{camera_name}/processed"
-
-                if detections:
-                    payload = {
-                        "detections": detections,
-                        "count": len(detections)
-                    }
-                    # Find the detection with the highest confidence
-                    best_detection = max(detections, key=lambda x: x['confidence'])
-                    processed_payload = best_detection
-                else:
-                    payload = {
-                        "detections": [{"object": "none", "confidence": 1.0}],
-                        "count": 0
-                    }
-                    processed_payload = {"object": "none", "confidence": 1.0}
-
-                # Publish to main state topic
-                payload_str = json.dumps(payload)
-                logging.debug(f"Publishing to {state_topic}: {payload_str}")
-                client.publish(state_topic, payload_str)
-                logging.info(f"Published detections for {camera_name}: {payload['detections']}")
-
-                # Publish to processed topic
-                processed_payload_str = json.dumps(processed_payload)
-                logging.debug(f"Publishing to {processed_topic}: {processed_payload_str}")
-                client.publish(processed_topic, processed_payload_str)
-                logging.info(f"Published processed detection for {camera_name}: {processed_payload}")
-
-            else:
-                logging.warning(f"Skipping prediction for {camera_name} due to camera error.")
+        for camera_name, detections in detections_by_camera.items():
+            # --- D. Publish to MQTT ---
+            state_topic, processed_topic = TOPICS[camera_name]
+            publish_detections(client, camera_name, state_topic, processed_topic, detections)
 
         # --- E. Sleep ---
-        # Calculate execution time for all cameras
-        elapsed = time.time() - start_time
-        sleep_time = max(0, INTERVAL - elapsed)
-        
+        # Sleep until the next scheduled tick; if this one overran, start the next immediately
+        now = time.monotonic()
+        sleep_time = max(0, next_tick - now)
+        if sleep_time == 0:
+            next_tick = now
+
         logging.info(f"All cameras processed. Sleeping for {sleep_time:.2f} seconds.")
         time.sleep(sleep_time)
 
@@ -0,0 +1,61 @@
+# cv_hot.py
+"""Per-tick result processing and MQTT publishing for cv_camera.py.
+
+These helpers are fully annotated and hold no module state so they can be
+compiled ahead of time with mypyc (`mypyc cv_hot.py`); if no compiled module
+is present, Python imports this file as-is.
+"""
+import logging
+from typing import Any, Dict, List
+
+import numpy as np
+import orjson
+
+Detection = Dict[str, Any]
+
+
+def extract_detections(result: Any, names: Any) -> List[Detection]:
+    """Turns one frame's boxes into detection dicts with a single device-to-host copy."""
+    # boxes.data columns are x1, y1, x2, y2, conf, cls
+    data = result.boxes.data[:, 4:6].cpu().numpy().astype(np.float64)
+    confidences: List[float] = data[:, 0].round(2).tolist()
+    class_names: List[str] = names[data[:, 1].astype(np.int32)].tolist()
+    detections: List[Detection] = []
+    for class_name, confidence in zip(class_names, confidences):
+        detections.append({"object": class_name, "confidence": confidence})
+    return detections
+
+
+def _confidence(detection: Detection) -> float:
+    confidence: float = detection["confidence"]
+    return confidence
+
+
+def publish_detections(client: Any, camera_name: str, state_topic: str, processed_topic: str,
+                       detections: List[Detection]) -> None:
+    """Publishes a camera's detections to its state topic and the best one to its processed topic."""
+    if detections:
+        payload: Dict[str, Any] = {
+            "detections": detections,
+            "count": len(detections)
+        }
+        # Find the detection with the highest confidence
+        processed_payload: Detection = max(detections, key=_confidence)
+    else:
+        payload = {
+            "detections": [{"object": "none", "confidence": 1.0}],
+            "count": 0
+        }
+        processed_payload = {"object": "none", "confidence": 1.0}
+
+    # Publish to main state topic
+    payload_bytes: bytes = orjson.dumps(payload)
+    logging.debug(f"Publishing to {state_topic}: {payload_bytes.decode()}")
+    client.publish(state_topic, payload_bytes, qos=0, retain=False)
+    logging.info(f"Published detections for {camera_name}: {payload['detections']}")
+
+    # Publish to processed topic
+    processed_payload_bytes: bytes = orjson.dumps(processed_payload)
+    logging.debug(f"Publishing to {processed_topic}: {processed_payload_bytes.decode()}")
+    client.publish(processed_topic, processed_payload_bytes, qos=0, retain=False)
+    logging.info(f"Published processed detection for {camera_name}: {processed_payload}")